@@ -0,0 +1,133 @@
+"""Numeric kernels for alignment filtering, compiled with Numba when installed"""
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+HAVE_NUMBA = njit is not None
+
+def _paf_keep_mask_numpy(matches, aln_len, target_len, min_identity, min_coverage):
+    matches = matches.astype(np.float64)
+    aln_len = aln_len.astype(np.float64)
+    target_len = target_len.astype(np.float64)
+    identity = np.divide(matches, aln_len, out=np.zeros_like(matches), where=aln_len > 0)
+    coverage = np.divide(aln_len, target_len, out=np.zeros_like(aln_len), where=target_len > 0)
+    return (identity >= min_identity) & (coverage >= min_coverage)
+
+def _find_tabs_nl_numpy(buf):
+    return np.flatnonzero(buf == 0x09), np.flatnonzero(buf == 0x0A)
+
+def _overlap_remove_mask_numpy(name_codes, t_start, t_end, identity):
+    same_read = name_codes[:-1] == name_codes[1:]
+    overlap = np.minimum(t_end[:-1], t_end[1:]) - np.maximum(t_start[:-1], t_start[1:])
+    min_len = np.minimum(t_end[:-1] - t_start[:-1], t_end[1:] - t_start[1:])
+    is_overlap = same_read & (min_len > 0) & (overlap / np.maximum(min_len, 1) > 0.8)
+
+    # Remove lower identity hit of each overlapping pair
+    pair_idx = np.flatnonzero(is_overlap)
+    remove = np.zeros(len(t_start), dtype=bool)
+    remove[np.where(identity[pair_idx] > identity[pair_idx + 1], pair_idx + 1, pair_idx)] = True
+    return remove
+
+if HAVE_NUMBA:
+    # Serial kernels: they are called from the pipeline's worker threads,
+    # which Numba's parallel threading layers do not support
+    @njit(cache=True)
+    def _paf_keep_mask_jit(matches, aln_len, target_len, min_identity, min_coverage):
+        n = len(matches)
+        keep = np.empty(n, dtype=np.bool_)
+        for i in range(n):
+            identity = matches[i] / aln_len[i] if aln_len[i] > 0 else 0.0
+            coverage = aln_len[i] / target_len[i] if target_len[i] > 0 else 0.0
+            keep[i] = identity >= min_identity and coverage >= min_coverage
+        return keep
+
+    @njit(cache=True)
+    def _zero_bytes(x):
+        # High bit set in exactly the bytes of x that are zero
+        low7 = np.uint64(0x7F7F7F7F7F7F7F7F)
+        return ~(((x & low7) + low7) | x | low7)
+
+    @njit(cache=True)
+    def _scan_words(words, w, tabs, n_tabs, newlines, n_newlines):
+        # Scan from word w until the words run out or an output array
+        # cannot take another word's worth of offsets
+        tab_bytes = np.uint64(0x0909090909090909)
+        nl_bytes = np.uint64(0x0A0A0A0A0A0A0A0A)
+        while w < len(words) and n_tabs + 8 <= len(tabs) and n_newlines + 8 <= len(newlines):
+            v = words[w]
+            hit_tab = _zero_bytes(v ^ tab_bytes)
+            hit_nl = _zero_bytes(v ^ nl_bytes)
+            if hit_tab | hit_nl:
+                for k in range(8):
+                    bit = np.uint64(1) << np.uint64(8 * k + 7)
+                    if hit_tab & bit:
+                        tabs[n_tabs] = w * 8 + k
+                        n_tabs += 1
+                    elif hit_nl & bit:
+                        newlines[n_newlines] = w * 8 + k
+                        n_newlines += 1
+            w += 1
+        return w, n_tabs, n_newlines
+
+    @njit(cache=True)
+    def _find_tabs_nl_jit(buf):
+        n = len(buf)
+        n_words = n // 8
+        words = buf[:n_words * 8].view(np.uint64)
+        # Sized for typical PAF field density and doubled when full
+        tabs = np.empty(n // 8 + 16, dtype=np.int64)
+        newlines = np.empty(n // 64 + 16, dtype=np.int64)
+        w, n_tabs, n_newlines = _scan_words(words, 0, tabs, 0, newlines, 0)
+        while w < n_words or n_tabs + 8 > len(tabs) or n_newlines + 8 > len(newlines):
+            if n_tabs + 8 > len(tabs):
+                tabs = np.concatenate((tabs, np.empty_like(tabs)))
+            if n_newlines + 8 > len(newlines):
+                newlines = np.concatenate((newlines, np.empty_like(newlines)))
+            w, n_tabs, n_newlines = _scan_words(words, w, tabs, n_tabs, newlines, n_newlines)
+        # Trailing partial word; the loop above left room for eight offsets
+        for i in range(n_words * 8, n):
+            if buf[i] == 0x09:
+                tabs[n_tabs] = i
+                n_tabs += 1
+            elif buf[i] == 0x0A:
+                newlines[n_newlines] = i
+                n_newlines += 1
+        return tabs[:n_tabs], newlines[:n_newlines]
+
+    @njit(cache=True)
+    def _overlap_remove_mask_jit(name_codes, t_start, t_end, identity):
+        n = len(t_start)
+        remove = np.zeros(n, dtype=np.bool_)
+        for i in range(n - 1):
+            if name_codes[i] != name_codes[i + 1]:
+                continue
+            overlap = min(t_end[i], t_end[i + 1]) - max(t_start[i], t_start[i + 1])
+            min_len = min(t_end[i] - t_start[i], t_end[i + 1] - t_start[i + 1])
+            if min_len > 0 and overlap / min_len > 0.8:
+                if identity[i] > identity[i + 1]:
+                    remove[i + 1] = True
+                else:
+                    remove[i] = True
+        return remove
+
+def paf_keep_mask(matches, aln_len, target_len, min_identity, min_coverage):
+    """Identity/coverage test for PAF records given their integer columns"""
+    if HAVE_NUMBA:
+        return _paf_keep_mask_jit(matches, aln_len, target_len,
+                                  float(min_identity), float(min_coverage))
+    return _paf_keep_mask_numpy(matches, aln_len, target_len, min_identity, min_coverage)
+
+def find_tabs_nl(buf):
+    """Offsets of the tab and newline bytes in a uint8 buffer"""
+    if HAVE_NUMBA:
+        return _find_tabs_nl_jit(buf)
+    return _find_tabs_nl_numpy(buf)
+
+def overlap_remove_mask(name_codes, t_start, t_end, identity):
+    """Mark the lower identity hit of each overlapping adjacent pair of sorted hits"""
+    if HAVE_NUMBA:
+        return _overlap_remove_mask_jit(name_codes, t_start, t_end, identity)
+    return _overlap_remove_mask_numpy(name_codes, t_start, t_end, identity)
@@ -1,156 +1,480 @@
+import csv
+import hashlib
+import mmap
 import os
+import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
+import numpy as np
 import logging
 from pathlib import Path
-from .utils import check_dependencies, run_command, parse_paf, parse_centrifuge
+from ._fastfilter import find_tabs_nl, paf_keep_mask, overlap_remove_mask
+from .utils import (check_dependencies, run_command, run_command_async, run_async,
+                    parse_paf, parse_centrifuge_df, read_tsv, write_tsv, advise_sequential,
+                    atomic_path, HIT_COLUMNS)
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
 
 logger = logging.getLogger(__name__)
 
+# Fields of the merged results table
+MERGED_COLUMNS = ['read_id', 'plasmid_match', 'type', 'gene_name', 'gene_length',
+                  'start', 'end', 'strand', 'taxID']
+
+# Bytes of mapped PAF text scanned per window
+PAF_CHUNK_BYTES = 64 * 1024 * 1024
+
+# Rows per chunk when streaming read IDs from alignment tables
+READ_ID_CHUNK_ROWS = 1_000_000
+
+# Bytes of sample FASTA hashed to key cached LAST training results
+TRAIN_KEY_BYTES = 1024 * 1024
+
+# PSL columns read by filter_mge; the block lists are never used
+PSL_COLUMNS = [0, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17]
+
+# DuckDB read_csv options for headerless, unquoted TSV with ragged rows
+DUCKDB_TSV_OPTIONS = ("delim='\\t', header=false, auto_detect=false, quote='', escape='', "
+                      "null_padding=true, strict_mode=false")
+
+# Per-sample working directories, relative to the output directory
+WORK_DIRS = ('rawdata', 'ARG', 'plsdb', 'MGE', 'centrifuge', 'merged')
+
+# Output buffer size and the batch of kept lines joined per write call
+OUTPUT_BUFFER_BYTES = 8 * 1024 * 1024
+OUTPUT_BATCH_BYTES = 1024 * 1024
+
+def _index_lines(buf):
+    """Line and tab offsets of a uint8 buffer of tab-separated text"""
+    tabs, line_ends = find_tabs_nl(buf)
+    if len(buf) and buf[-1] != ord('\n'):
+        line_ends = np.append(line_ends, len(buf))
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+    first_tab = np.searchsorted(tabs, line_starts)
+    n_tabs = np.searchsorted(tabs, line_ends) - first_tab
+    return line_starts, line_ends, tabs, first_tab, n_tabs
+
+def _mmap_tab_int(buf, index, col):
+    """Parse integer column col of each line, with a mask of the lines where it is valid"""
+    line_starts, line_ends, tabs, first_tab, n_tabs = index
+    valid = n_tabs >= col
+    if len(tabs) == 0:
+        tabs = np.zeros(1, dtype=np.intp)
+    if col == 0:
+        start = line_starts
+    else:
+        start = np.where(valid, tabs[np.minimum(first_tab + col - 1, len(tabs) - 1)] + 1, 0)
+    has_next_tab = n_tabs > col
+    end = np.where(has_next_tab, tabs[np.minimum(first_tab + col, len(tabs) - 1)], line_ends)
+    length = np.where(valid, end - start, 0)
+    valid &= (length > 0) & (length <= 18)
+    
+    # Horner's rule over digit positions, one vectorized step per digit
+    values = np.zeros(len(start), dtype=np.int64)
+    last = len(buf) - 1
+    for j in range(int(length.max(initial=0))):
+        active = valid & (j < length)
+        digit = (buf[np.minimum(start + j, last)] - ord('0')).astype(np.int64)
+        valid &= ~active | ((digit >= 0) & (digit <= 9))
+        values = np.where(active, values * 10 + digit, values)
+    return values, valid
+
+def _matching_reads(paf_file, read_ids):
+    """Read IDs in the first column of a PAF that also occur in read_ids, read in chunks"""
+    matched = []
+    for chunk in pd.read_csv(paf_file, sep='\t', header=None, usecols=[0], names=['read_id'],
+                             dtype=str, na_filter=False, quoting=csv.QUOTE_NONE,
+                             chunksize=READ_ID_CHUNK_ROWS):
+        ids = chunk['read_id']
+        matched.append(ids[ids.isin(read_ids)].unique())
+    return np.unique(np.concatenate(matched)) if matched else []
+
+def _madvise(mm, advice, start=0, length=0):
+    """Apply an mmap.MADV_* hint if the platform supports it"""
+    option = getattr(mmap, advice, None)
+    if option is None:
+        return
+    # The range must start on a page boundary
+    aligned = start - start % mmap.PAGESIZE
+    if length:
+        length = min(length + start - aligned, len(mm) - aligned)
+    try:
+        mm.madvise(option, aligned, length)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+def _file_key(path):
+    """Short hash identifying a file by location, size and modification time"""
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}\0{st.st_size}\0{st.st_mtime_ns}"
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def _link_or_copy(src, dst):
+    """Point dst at src, copying if symlinks are not supported"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.symlink(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+def _cache_copy(src, dst):
+    """Copy src into the cache atomically; caching failures are not fatal"""
+    try:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        with atomic_path(dst) as tmp:
+            shutil.copy(src, tmp)
+    except OSError as e:
+        logger.warning(f"Could not cache {src}: {e}")
+
 class AnalysisPipeline:
-    def __init__(self, config):
+    def __init__(self, config, output_dir=None):
         self.config = config
-        self.path = os.getcwd()
+        # All work files live under this absolute path; the cwd is never used
+        self.path = os.path.abspath(output_dir or os.getcwd())
+        self._present = None
+        # Filtered MGE hits by sample, kept for merge_results
+        self._mge_df = {}
+        self._mge_write = {}
         
     def run(self, input_path, sample_name, skip_dehost=False, skip_centrifuge=False):
         """Run complete analysis pipeline"""
         
         # Check dependencies
         check_dependencies()
+        self.scan_work_dirs()
         
-        # Step 0: Prepare data
-        self.prepare_data(input_path, sample_name)
-        
-        # Step 1: Run centrifuge (taxonomic classification)
+        # Steps 1-4 only read the FASTA and write to separate directories,
+        # so they run concurrently with the thread budget split between them
+        jobs = {}
         if not skip_centrifuge:
-            self.run_centrifuge(sample_name)
+            jobs['centrifuge'] = self.run_centrifuge
         else:
             logger.info("Skipping Centrifuge step as requested.")
-        
-        # Step 2: ARG identification
-        self.run_arg_identification(sample_name)
-        
-        # Step 3: Plasmid identification
-        self.run_plasmid_identification(sample_name)
-        
-        # Step 4: MGE identification
-        self.run_mge_identification(sample_name)
-        
-        # Step 5: Filter results
-        self.filter_results(sample_name)
+        jobs['arg'] = self.run_arg_identification
+        jobs['plasmid'] = self.run_plasmid_identification
+        jobs['mge'] = self.run_mge_identification
+        
+        # Step 0: Prepare data. LAST trains on and re-reads the FASTA, so only
+        # the single-pass steps can take it from a stream.
+        stream_to = [name for name in jobs if name != 'mge'] if self.config.get('stream_fasta') else []
+        query_fds = self.prepare_data(input_path, sample_name, stream_to=stream_to)
+        
+        # Step 5: Filter results. Each filter starts as soon as its alignment
+        # step is done, overlapping with the steps still running.
+        filters = {
+            'arg': self.filter_arg_results,
+            'plasmid': self.filter_plasmid_results,
+            'mge': self.filter_mge,
+        }
+        
+        threads_per_job = max(1, self.config['threads'] // len(jobs))
+        try:
+            with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+                futures = {executor.submit(self._run_step, job, sample_name, threads_per_job,
+                                           query_fds.get(name)): name
+                           for name, job in jobs.items()}
+                pending = set(futures)
+                while pending:
+                    future = next(as_completed(pending))
+                    pending.remove(future)
+                    future.result()
+                    name = futures.pop(future, None)
+                    if name in filters:
+                        pending.add(executor.submit(filters[name], sample_name))
+        finally:
+            self.finish_fasta_stream(sample_name)
+        self.record_stats(sample_name)
         
         # Step 6: Merge results
         self.merge_results(sample_name)
         
         return True
     
-    def prepare_data(self, input_path, sample_name):
-        """Prepare input data and calculate statistics"""
+    def prepare_data(self, input_path, sample_name, stream_to=()):
+        """Prepare input data; returns the pipe each step in stream_to reads the FASTA from"""
         logger.info(f"Preparing data for sample: {sample_name}")
         
         # Create symlink if input is a file
+        fastq = self.out_path("rawdata", f"{sample_name}.fastq.gz")
         if os.path.isfile(input_path):
-            target = f"rawdata/{sample_name}.fastq.gz"
-            if not os.path.exists(target):
+            if not self.exists(fastq):
                 try:
-                    os.symlink(os.path.abspath(input_path), target)
+                    os.symlink(os.path.abspath(input_path), fastq)
                 except OSError as e:
                     logger.warning(f"Could not create symlink: {e}. Copying file instead.")
-                    import shutil
-                    shutil.copy(input_path, target)
+                    shutil.copy(input_path, fastq)
+                self.mark_present(fastq)
         
-        # Calculate sequence statistics
-        cmd = f"seqkit stats rawdata/{sample_name}.fastq.gz -T"
-        result = run_command(cmd, capture_output=True)
+        # Calculate sequence statistics in the background; the output is
+        # collected by record_stats once the alignment steps are running
+        cmd = ["seqkit", "stats", fastq, "-T"]
+        self._stats = run_command_async(cmd, capture_output=True)
+        
+        # Convert to FASTA if needed
+        fa_file = self.out_path("rawdata", f"{sample_name}.fa")
+        if self.exists(fa_file):
+            return {}
         
+        if stream_to:
+            try:
+                return self.start_fasta_stream(sample_name, stream_to)
+            except OSError as e:
+                logger.warning(f"Could not stream FASTA: {e}. Writing it to disk first.")
+        
+        cmd = ["seqtk", "seq", "-A", fastq]
+        run_command(cmd, stdout=fa_file)
+        self.mark_present(fa_file)
+        return {}
+    
+    def scan_work_dirs(self):
+        """List the working directories once so existence checks need no stat"""
+        self._present = {}
+        for d in WORK_DIRS:
+            d = self.out_path(d)
+            try:
+                self._present[d] = set(os.listdir(d))
+            except OSError:
+                self._present[d] = set()
+    
+    def exists(self, path):
+        """os.path.exists, answered from the directory listing when there is one"""
+        directory, name = os.path.split(path)
+        if self._present is not None and directory in self._present:
+            return name in self._present[directory]
+        return os.path.exists(path)
+    
+    def mark_present(self, path):
+        """Record a file created in a working directory since the listing"""
+        directory, name = os.path.split(path)
+        if self._present is not None and directory in self._present:
+            self._present[directory].add(name)
+    
+    def out_path(self, *parts):
+        """Absolute path of a file in the output directory"""
+        return os.path.join(self.path, *parts)
+    
+    def start_fasta_stream(self, sample_name, consumers):
+        """Decode the FASTQ once and tee the FASTA to disk and to one pipe per consumer"""
+        if not os.path.isdir("/dev/fd"):
+            raise OSError("/dev/fd is not available")
+        
+        fa_part = self.out_path("rawdata", f"{sample_name}.fa.part")
+        pipes = {name: os.pipe() for name in consumers}
+        write_fds = [w for _, w in pipes.values()]
+        seqtk = None
+        try:
+            fastq = self.out_path("rawdata", f"{sample_name}.fastq.gz")
+            seqtk = subprocess.Popen(["seqtk", "seq", "-A", fastq],
+                                     stdout=subprocess.PIPE)
+            with open(fa_part, 'wb') as f_out:
+                # -p: keep feeding the other consumers if one exits early
+                tee = subprocess.Popen(["tee", "-p"] + [f"/dev/fd/{w}" for w in write_fds],
+                                       stdin=seqtk.stdout, stdout=f_out, pass_fds=write_fds)
+        except OSError:
+            if seqtk is not None:
+                seqtk.kill()
+                seqtk.wait()
+            for r, _ in pipes.values():
+                os.close(r)
+            raise
+        finally:
+            if seqtk is not None:
+                seqtk.stdout.close()
+            for w in write_fds:
+                os.close(w)
+        
+        self._fasta_stream = (seqtk, tee)
+        return {name: r for name, (r, _) in pipes.items()}
+    
+    def finish_fasta_stream(self, sample_name):
+        """Wait for a running FASTA stream and move the FASTA into place"""
+        stream = getattr(self, '_fasta_stream', None)
+        if stream is None:
+            return
+        self._fasta_stream = None
+        
+        for proc in stream:
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        fa_file = self.out_path("rawdata", f"{sample_name}.fa")
+        os.replace(f"{fa_file}.part", fa_file)
+        self.mark_present(fa_file)
+    
+    def _run_step(self, step, sample_name, threads, query_fd=None):
+        """Run one alignment step, reading the FASTA from query_fd if given"""
+        if query_fd is None:
+            return step(sample_name, threads)
+        try:
+            return step(sample_name, threads, query_fd=query_fd)
+        finally:
+            # Closing our copy lets tee see EPIPE if the step died early
+            os.close(query_fd)
+    
+    def fasta_query(self, sample_name, query_fd=None):
+        """Query path and fds to pass for a step's FASTA input"""
+        if query_fd is None:
+            return self.out_path("rawdata", f"{sample_name}.fa"), ()
+        return f"/dev/fd/{query_fd}", (query_fd,)
+    
+    def record_stats(self, sample_name):
+        """Save the total read length reported by seqkit stats"""
+        stats = getattr(self, '_stats', None)
+        if stats is None:
+            return
+        self._stats = None
+        
+        result = stats.result()
         if result and result.stdout:
             # Parse and save stats
             try:
-                with open(f"sum_length.txt", 'w') as f:
-                    f.write(f"{sample_name}\t{result.stdout.split()[3]}\n")
-            except IndexError:
+                header, values = result.stdout.splitlines()[:2]
+                sum_len = dict(zip(header.split('\t'), values.split('\t')))['sum_len']
+                with open(self.out_path("sum_length.txt"), 'w') as f:
+                    f.write(f"{sample_name}\t{sum_len}\n")
+            except (ValueError, KeyError):
                 logger.warning("Could not parse seqkit output.")
-        
-        # Convert to FASTA if needed
-        fa_file = f"rawdata/{sample_name}.fa"
-        if not os.path.exists(fa_file):
-            cmd = f"seqtk seq -A rawdata/{sample_name}.fastq.gz > {fa_file}"
-            run_command(cmd)
     
-    def run_centrifuge(self, sample_name):
+    def run_centrifuge(self, sample_name, threads=None, query_fd=None):
         """Run centrifuge for taxonomic classification"""
         logger.info("Running centrifuge...")
+        threads = threads or self.config['threads']
+        query, pass_fds = self.fasta_query(sample_name, query_fd)
         db_path = self.config['database']['centrifuge']
-        cmd = f"""centrifuge -f -x {db_path} \
-                -U rawdata/{sample_name}.fa \
-                --report-file centrifuge/{sample_name}_report.tsv \
-                -S centrifuge/{sample_name}_result.tsv \
-                -p {self.config['threads']}"""
-        run_command(cmd)
+        out_prefix = self.out_path("centrifuge", sample_name)
+        cmd = ["centrifuge", "-f", "-x", db_path,
+               "-U", query,
+               "--report-file", f"{out_prefix}_report.tsv",
+               "-S", f"{out_prefix}_result.tsv",
+               "-p", str(threads)]
+        run_command(cmd, pass_fds=pass_fds)
     
-    def run_arg_identification(self, sample_name):
+    def run_arg_identification(self, sample_name, threads=None, query_fd=None):
         """Identify ARGs using minimap2"""
         logger.info("Identifying ARGs...")
+        threads = threads or self.config['threads']
+        query, pass_fds = self.fasta_query(sample_name, query_fd)
         db_path = self.config['database']['card']
-        cmd = f"""minimap2 -x map-ont --secondary=no \
-                -t {self.config['threads']} \
-                {db_path} \
-                rawdata/{sample_name}.fa > ARG/{sample_name}_ARG.paf"""
-        run_command(cmd)
+        cmd = (["minimap2", "-x", "map-ont", "--secondary=no",
+                "-t", str(threads)] + self.minimap2_batch_args() +
+               ["--split-prefix", self.out_path("ARG", f"{sample_name}_split"),
+                db_path, query])
+        run_command(cmd, pass_fds=pass_fds, stdout=self.out_path("ARG", f"{sample_name}_ARG.paf"))
+    
+    def minimap2_batch_args(self):
+        """Query minibatch (-K) and index split (-I) sizes for minimap2"""
+        # Larger -K keeps more worker threads busy at the cost of RAM
+        return ["-K", str(self.config.get('minimap2_K', '500M')),
+                "-I", str(self.config.get('minimap2_I', '8G'))]
     
-    def run_plasmid_identification(self, sample_name):
+    def run_plasmid_identification(self, sample_name, threads=None, query_fd=None):
         """Identify plasmids using minimap2"""
         logger.info("Identifying plasmids...")
+        threads = threads or self.config['threads']
+        query, pass_fds = self.fasta_query(sample_name, query_fd)
         db_path = self.config['database']['plsdb']
-        cmd = f"""minimap2 -x map-ont --secondary=no \
-                -t {self.config['threads']} \
-                {db_path} \
-                rawdata/{sample_name}.fa > plsdb/{sample_name}_plsdb.paf"""
-        run_command(cmd)
+        cmd = (["minimap2", "-x", "map-ont", "--secondary=no",
+                "-t", str(threads)] + self.minimap2_batch_args() +
+               ["--split-prefix", self.out_path("plsdb", f"{sample_name}_split"),
+                db_path, query])
+        run_command(cmd, pass_fds=pass_fds, stdout=self.out_path("plsdb", f"{sample_name}_plsdb.paf"))
     
-    def run_mge_identification(self, sample_name):
+    def run_mge_identification(self, sample_name, threads=None):
         """Identify MGEs using LAST"""
         logger.info("Identifying MGEs...")
+        threads = threads or self.config['threads']
         
         # Create database if not exists
         mge_db = self.config['database']['mge']
-        if not os.path.exists(mge_db + ".bck") and not os.path.exists(mge_db + ".prj"):
-             # Check if we need to build the index
-             logger.info(f"Building LAST index for {mge_db}...")
-             cmd = f"lastdb -P{self.config['threads']} -q -c trandb {mge_db}"
-             run_command(cmd)
+        db_key = _file_key(mge_db)
+        lastdb = os.path.join(self.cache_dir(), "lastdb", db_key, "trandb")
+        if not os.path.exists(lastdb + ".prj"):
+            logger.info(f"Building LAST index for {mge_db}...")
+            try:
+                self.build_lastdb(mge_db, lastdb, threads)
+            except OSError as e:
+                # An unusable cache must not fail the run
+                logger.warning(f"Could not build LAST index in cache: {e}. Building it in MGE/ instead.")
+                lastdb = self.out_path("MGE", db_key, "trandb")
+                if not os.path.exists(lastdb + ".prj"):
+                    self.build_lastdb(mge_db, lastdb, threads)
+        
+        # Run LAST once the streamed FASTA (if any) is complete on disk
+        self.finish_fasta_stream(sample_name)
+        sample_fa = self.out_path("rawdata", f"{sample_name}.fa")
+        maf_file = self.out_path("MGE", f"{sample_name}.maf")
+        train_file = self.out_path("MGE", f"{sample_name}.train")
+        cached_train = self.cached_train_path(sample_fa, db_key)
+        if os.path.exists(cached_train):
+            logger.info(f"Reusing cached LAST training: {cached_train}")
+            _link_or_copy(cached_train, train_file)
+        else:
+            run_command(["last-train", f"-P{threads}", "--codon", lastdb, sample_fa],
+                        stdout=train_file)
+            _cache_copy(train_file, cached_train)
         
-        # Run LAST
         cmds = [
-            f"last-train -P{self.config['threads']} --codon trandb rawdata/{sample_name}.fa > MGE/{sample_name}.train",
-            f"lastal -P{self.config['threads']} -p MGE/{sample_name}.train -m100 -D1e9 -K1 trandb rawdata/{sample_name}.fa > MGE/{sample_name}.maf",
-            f"maf-convert psl MGE/{sample_name}.maf > MGE/{sample_name}_alignments.psl"
+            (["lastal", f"-P{threads}", "-p", train_file, "-m100", "-D1e9", "-K1", lastdb, sample_fa],
+             maf_file),
+            (["maf-convert", "psl", maf_file], self.out_path("MGE", f"{sample_name}_alignments.psl"))
         ]
-        for cmd in cmds:
-            run_command(cmd)
+        for cmd, output in cmds:
+            run_command(cmd, stdout=output)
     
-    def filter_results(self, sample_name):
-        """Filter alignment results"""
-        logger.info("Filtering results...")
-        
-        # Filter ARG results
+    def cache_dir(self):
+        """Directory for indexes and training results shared across runs"""
+        cache_dir = self.config.get('cache_dir')
+        if not cache_dir:
+            xdg_cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+            cache_dir = os.path.join(xdg_cache, "easy_arg")
+        return os.path.abspath(os.path.expanduser(cache_dir))
+    
+    def build_lastdb(self, mge_db, lastdb, threads):
+        """Build a LAST index into a private directory, then move it into place"""
+        db_dir = os.path.dirname(lastdb)
+        os.makedirs(os.path.dirname(db_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(db_dir) + ".", dir=os.path.dirname(db_dir))
+        try:
+            run_command(["lastdb", f"-P{threads}", "-q", "-c", os.path.join(tmp_dir, "trandb"), mge_db])
+            os.rename(tmp_dir, db_dir)
+        except OSError:
+            # Another run finished the same index first
+            if not os.path.exists(lastdb + ".prj"):
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    def cached_train_path(self, sample_fa, db_key):
+        """Cache path of a last-train result, keyed on the MGE database and first MiB of reads"""
+        digest = hashlib.sha256(db_key.encode())
+        with open(sample_fa, 'rb') as f:
+            digest.update(f.read(TRAIN_KEY_BYTES))
+        return os.path.join(self.cache_dir(), "train", f"{digest.hexdigest()}.train")
+    
+    def filter_arg_results(self, sample_name):
+        """Filter ARG alignments"""
+        logger.info("Filtering ARG results...")
         self.filter_paf(
-            f"ARG/{sample_name}_ARG.paf",
-            f"ARG/{sample_name}_ARG_filtered.txt",
+            self.out_path("ARG", f"{sample_name}_ARG.paf"),
+            self.out_path("ARG", f"{sample_name}_ARG_filtered.txt"),
             min_identity=self.config.get('min_identity', 0.75),
             min_coverage=self.config.get('min_coverage', 0.9) # Note: ARG usually requires higher coverage
         )
-        
-        # Filter plasmid results
+    
+    def filter_plasmid_results(self, sample_name):
+        """Filter plasmid alignments"""
+        logger.info("Filtering plasmid results...")
         self.filter_paf(
-            f"plsdb/{sample_name}_plsdb.paf",
-            f"plsdb/{sample_name}_plsdb_filtered.txt",
+            self.out_path("plsdb", f"{sample_name}_plsdb.paf"),
+            self.out_path("plsdb", f"{sample_name}_plsdb_filtered.txt"),
             min_identity=0.7,
             min_coverage=0.7
         )
-        
-        # Filter MGE results
-        self.filter_mge(sample_name)
     
     def filter_paf(self, input_file, output_file, min_identity, min_coverage):
         """Filter PAF format alignments"""
@@ -159,27 +483,65 @@ class AnalysisPipeline:
             return
         
         try:
-            with open(input_file, 'r') as f_in, open(output_file, 'w') as f_out:
-                for line in f_in:
-                    parts = line.strip().split('\t')
-                    if len(parts) >= 11:
-                        # Calculate identity and coverage
-                        matches = int(parts[9])
-                        aln_len = int(parts[10])
-                        target_len = int(parts[6])
-                        
-                        identity = matches / aln_len if aln_len > 0 else 0
-                        coverage = aln_len / target_len if target_len > 0 else 0
-                        
-                        if identity >= min_identity and coverage >= min_coverage:
-                            f_out.write(line)
+            with open(input_file, 'rb') as f_in, \
+                    open(output_file, 'wb', buffering=OUTPUT_BUFFER_BYTES) as f_out:
+                size = os.fstat(f_in.fileno()).st_size
+                if size == 0:
+                    return
+                advise_sequential(f_in)
+                with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    _madvise(mm, 'MADV_SEQUENTIAL')
+                    # Errors are logged before the map closes: their traceback
+                    # still references NumPy views of it, which blocks close()
+                    try:
+                        pos = 0
+                        while pos < size:
+                            # Windows end on a line break so no record is split
+                            end = mm.find(b'\n', min(pos + PAF_CHUNK_BYTES, size) - 1)
+                            end = size if end == -1 else end + 1
+                            # Fault in the next window while this one is parsed
+                            if end < size:
+                                _madvise(mm, 'MADV_WILLNEED', end, PAF_CHUNK_BYTES)
+                            self._filter_paf_window(mm, pos, end, f_out,
+                                                    min_identity, min_coverage)
+                            pos = end
+                    except Exception as e:
+                        logger.error(f"Error filtering PAF file {input_file}: {e}")
         except Exception as e:
             logger.error(f"Error filtering PAF file {input_file}: {e}")
     
+    def _filter_paf_window(self, mm, pos, end, f_out, min_identity, min_coverage):
+        """Filter the PAF records in mm[pos:end] and write the kept lines"""
+        buf = np.frombuffer(mm, dtype=np.uint8, count=end - pos, offset=pos)
+        index = _index_lines(buf)
+        target_len, ok_target = _mmap_tab_int(buf, index, 6)
+        matches, ok_matches = _mmap_tab_int(buf, index, 9)
+        aln_len, ok_aln = _mmap_tab_int(buf, index, 10)
+        keep = ok_target & ok_matches & ok_aln
+        keep &= paf_keep_mask(matches, aln_len, target_len, min_identity, min_coverage)
+        if not keep.any():
+            return
+        
+        # Coalesce runs of adjacent kept lines into single slices of the map
+        line_starts, line_ends = index[0], index[1]
+        starts = line_starts[keep] + pos
+        stops = np.minimum(line_ends[keep] + 1 + pos, end)
+        new_run = np.concatenate(([True], starts[1:] != stops[:-1]))
+        run_stops = np.append(stops[np.flatnonzero(new_run)[1:] - 1], stops[-1])
+        batch, batch_len = [], 0
+        for start, stop in zip(starts[new_run].tolist(), run_stops.tolist()):
+            batch.append(mm[start:stop])
+            batch_len += stop - start
+            if batch_len >= OUTPUT_BATCH_BYTES:
+                f_out.write(b''.join(batch))
+                batch, batch_len = [], 0
+        if batch:
+            f_out.write(b''.join(batch))
+    
     def filter_mge(self, sample_name):
-        """Filter MGE results"""
-        input_file = f"MGE/{sample_name}_alignments.psl"
-        output_file = f"MGE/{sample_name}_filtered_hits.txt"
+        """Filter MGE results; returns the hits and writes the TSV in the background"""
+        input_file = self.out_path("MGE", f"{sample_name}_alignments.psl")
+        output_file = self.out_path("MGE", f"{sample_name}_filtered_hits.txt")
         
         if not os.path.exists(input_file):
             logger.warning(f"MGE alignment file not found: {input_file}")
@@ -194,132 +556,211 @@ class AnalysisPipeline:
         ]
         
         try:
-            df = pd.read_csv(input_file, sep='\t', header=None, names=col_names)
+            with open(input_file, 'rb') as f:
+                advise_sequential(f)
+                df = read_tsv(f, col_names, [col_names[i] for i in PSL_COLUMNS])
             if df.empty:
                 logger.warning("No MGE hits found.")
                 return
 
-            df['protein_align_length'] = df['q_end'] - df['q_start']
-            df['coverage'] = df['protein_align_length'] / df['q_len']
-            df['identity'] = df['matches'] / df['protein_align_length']
+            # Derive the filter metrics as arrays rather than frame columns
+            output_cols = ['matches', 'strand', 'q_name', 'q_len', 'q_start',
+                          'q_end', 't_name', 't_len', 't_start', 't_end', 'block_count']
+            protein_align_length = (df['q_end'] - df['q_start']).to_numpy()
+            coverage = protein_align_length / df['q_len'].to_numpy()
+            identity = df['matches'].to_numpy() / np.maximum(protein_align_length, 1)
             
             # Filter
-            df_filtered = df[(df['coverage'] > 0.7) & (df['identity'] > 0.7)]
+            mask = (coverage > 0.7) & (identity > 0.7)
+            df_filtered = df.loc[mask, output_cols].copy()
+            df_filtered['identity'] = identity[mask]
             
             # Remove overlapping hits
             df_filtered = self.remove_overlapping_hits(df_filtered)
             
             # Save
-            output_cols = ['matches', 'strand', 'q_name', 'q_len', 'q_start',
-                          'q_end', 't_name', 't_len', 't_start', 't_end', 'block_count']
-            df_filtered[output_cols].to_csv(output_file, sep='\t', index=False)
+            df_filtered = df_filtered[output_cols]
+            self._mge_df[sample_name] = df_filtered
+            self._mge_write[sample_name] = run_async(write_tsv, df_filtered, output_file)
+            return df_filtered
             
         except Exception as e:
             logger.error(f"Error filtering MGE results: {e}")
     
+    def finish_mge_output(self, sample_name):
+        """Wait for the filtered MGE hits started by filter_mge to be written"""
+        mge_write = self._mge_write.pop(sample_name, None)
+        if mge_write is None:
+            return
+        try:
+            mge_write.result()
+        except Exception as e:
+            logger.error(f"Error writing filtered MGE hits: {e}")
+    
     def remove_overlapping_hits(self, df):
         """Remove overlapping MGE hits on same read"""
         if df.empty:
             return df
         
-        df = df.sort_values(['t_name', 't_start'])
-        df['to_remove'] = False
-        
-        # Reset index to ensure we can iterate correctly
-        df = df.reset_index(drop=True)
-        
-        for i in range(len(df) - 1):
-            if df.iloc[i]['t_name'] == df.iloc[i + 1]['t_name']:
-                # Calculate overlap
-                overlap = min(df.iloc[i]['t_end'], df.iloc[i + 1]['t_end']) - \
-                         max(df.iloc[i]['t_start'], df.iloc[i + 1]['t_start'])
-                
-                # Avoid division by zero
-                len1 = df.iloc[i]['t_end'] - df.iloc[i]['t_start']
-                len2 = df.iloc[i + 1]['t_end'] - df.iloc[i + 1]['t_start']
-                min_len = min(len1, len2)
-                
-                if min_len > 0 and overlap / min_len > 0.8:
-                    # Remove lower identity hit
-                    if df.iloc[i]['identity'] > df.iloc[i + 1]['identity']:
-                        df.at[i + 1, 'to_remove'] = True
-                    else:
-                        df.at[i, 'to_remove'] = True
-        
-        return df[~df['to_remove']].copy()
+        df = df.sort_values(['t_name', 't_start']).reset_index(drop=True)
+        
+        remove = overlap_remove_mask(
+            pd.factorize(df['t_name'])[0],
+            df['t_start'].to_numpy(dtype=np.int64),
+            df['t_end'].to_numpy(dtype=np.int64),
+            df['identity'].to_numpy(dtype=np.float64),
+        )
+        return df[~remove]
     
     def merge_results(self, sample_name):
         """Merge all results into a single file"""
         logger.info("Merging results...")
+        mge_df = self._mge_df.pop(sample_name, None)
+        
+        if self.config.get('use_duckdb'):
+            if duckdb is None:
+                logger.warning("use_duckdb is set but duckdb is not installed; merging with pandas")
+            else:
+                try:
+                    self.merge_results_duckdb(sample_name, mge_df)
+                    self.finish_mge_output(sample_name)
+                    return
+                except duckdb.Error as e:
+                    logger.warning(f"DuckDB merge failed: {e}. Merging with pandas instead.")
         
         merged_data = []
         
         # Parse ARG results
-        arg_file = f"ARG/{sample_name}_ARG_filtered.txt"
+        arg_file = self.out_path("ARG", f"{sample_name}_ARG_filtered.txt")
         if os.path.exists(arg_file):
-            arg_hits = parse_paf(arg_file, 'ARG')
-            merged_data.extend(arg_hits)
-        
-        # Parse MGE results
-        mge_file = f"MGE/{sample_name}_filtered_hits.txt"
-        if os.path.exists(mge_file):
-            mge_hits = self.parse_mge_results(mge_file)
-            merged_data.extend(mge_hits)
-        
-        # Parse centrifuge results
-        centrifuge_file = f"centrifuge/{sample_name}_result.tsv"
-        taxid_dict = {}
-        if os.path.exists(centrifuge_file):
-            taxid_dict = parse_centrifuge(centrifuge_file)
-        
-        # Parse plasmid results
-        plasmid_reads = set()
-        plasmid_file = f"plsdb/{sample_name}_plsdb_filtered.txt"
-        if os.path.exists(plasmid_file):
-            with open(plasmid_file, 'r') as f:
-                for line in f:
-                    parts = line.strip().split('\t')
-                    if parts:
-                        plasmid_reads.add(parts[0])
+            merged_data.append(parse_paf(arg_file, 'ARG'))
+        
+        # Parse MGE results, reusing the hits filter_mge kept in memory
+        mge_file = self.out_path("MGE", f"{sample_name}_filtered_hits.txt")
+        if mge_df is not None:
+            merged_data.append(self.mge_hits(mge_df))
+        elif os.path.exists(mge_file):
+            merged_data.append(self.parse_mge_results(mge_file))
+        
+        merged_data = [df for df in merged_data if len(df)]
+        if merged_data:
+            hits = pd.concat(merged_data, ignore_index=True)[HIT_COLUMNS]
+        else:
+            hits = pd.DataFrame(columns=HIT_COLUMNS)
+        
+        # Parse plasmid results, keeping only reads that carry a hit
+        plasmid_reads = []
+        plasmid_file = self.out_path("plsdb", f"{sample_name}_plsdb_filtered.txt")
+        if len(hits) and os.path.exists(plasmid_file) and os.path.getsize(plasmid_file) > 0:
+            plasmid_reads = _matching_reads(plasmid_file, hits['read_id'].unique())
+        
+        # Parse centrifuge results for the reads that carry a hit
+        centrifuge_file = self.out_path("centrifuge", f"{sample_name}_result.tsv")
+        taxa = pd.DataFrame(columns=['read_id', 'taxID'])
+        if len(hits) and os.path.exists(centrifuge_file):
+            taxa = parse_centrifuge_df(centrifuge_file, hits['read_id'].unique(),
+                                       chunksize=READ_ID_CHUNK_ROWS)
         
         # Write merged results
-        output_file = f"merged/{sample_name}_merged_results.tsv"
+        output_file = self.out_path("merged", f"{sample_name}_merged_results.tsv")
         try:
-            with open(output_file, 'w') as f:
-                f.write("read_id\tplasmid_match\ttype\tgene_name\tgene_length\tstart\tend\tstrand\ttaxID\n")
-                
-                for hit in merged_data:
-                    read_id = hit['read_id']
-                    plasmid_match = "plasmid" if read_id in plasmid_reads else "genome"
-                    taxid = taxid_dict.get(read_id, "0")
-                    
-                    f.write(f"{read_id}\t{plasmid_match}\t{hit['type']}\t{hit['gene_name']}\t"
-                           f"{hit['gene_length']}\t{hit['start']}\t{hit['end']}\t"
-                           f"{hit['strand']}\t{taxid}\n")
+            hits['plasmid_match'] = np.where(hits['read_id'].isin(plasmid_reads), 'plasmid', 'genome')
+            hits = hits.merge(taxa, on='read_id', how='left', validate='many_to_one')
+            hits['taxID'] = hits['taxID'].fillna('0')
+            write_tsv(hits[MERGED_COLUMNS], output_file)
         except Exception as e:
             logger.error(f"Error writing merged results: {e}")
+        
+        self.finish_mge_output(sample_name)
+    
+    def merge_results_duckdb(self, sample_name, mge_df=None):
+        """Merge all results with one DuckDB query, matching the pandas merge output"""
+        arg_file = self.out_path("ARG", f"{sample_name}_ARG_filtered.txt")
+        mge_file = self.out_path("MGE", f"{sample_name}_filtered_hits.txt")
+        plasmid_file = self.out_path("plsdb", f"{sample_name}_plsdb_filtered.txt")
+        centrifuge_file = self.out_path("centrifuge", f"{sample_name}_result.tsv")
+        output_file = self.out_path("merged", f"{sample_name}_merged_results.tsv")
+        
+        if mge_df is not None:
+            mge = self.mge_hits(mge_df)
+        elif os.path.exists(mge_file):
+            mge = self.parse_mge_results(mge_file)
+        else:
+            mge = pd.DataFrame(columns=HIT_COLUMNS)
+        
+        def table(path, columns):
+            """SQL for the first columns of a TSV, or an empty relation"""
+            if not (os.path.exists(path) and os.path.getsize(path) > 0):
+                nulls = ", ".join(f"NULL::VARCHAR AS {c}" for c in columns)
+                return f"SELECT {nulls}, NULL::BIGINT AS rn WHERE false"
+            spec = ", ".join(f"'{c}': 'VARCHAR'" for c in columns)
+            return (f"SELECT *, row_number() OVER () AS rn FROM read_csv(?, "
+                    f"columns={{{spec}}}, {DUCKDB_TSV_OPTIONS})")
+        
+        paf_columns = [f"c{i}" for i in range(11)]
+        params = [p for p in (arg_file, plasmid_file, centrifuge_file)
+                  if os.path.exists(p) and os.path.getsize(p) > 0]
+        query = f"""
+            WITH arg AS ({table(arg_file, paf_columns)}),
+            plasmid AS ({table(plasmid_file, ['read_id'])}),
+            centrifuge AS ({table(centrifuge_file, ['read_id', 'seq_id', 'tax_id'])}),
+            hits AS (
+                SELECT 0 AS src, rn, c0 AS read_id, 'ARG' AS type, c5 AS gene_name,
+                       c6::BIGINT AS gene_length, c2::BIGINT AS start, c3::BIGINT AS "end",
+                       c4 AS strand
+                FROM arg WHERE c10 IS NOT NULL
+                UNION ALL
+                SELECT 1, row_number() OVER (), read_id, type, gene_name,
+                       gene_length::BIGINT, start::BIGINT, "end"::BIGINT, strand
+                FROM mge
+            ),
+            -- Header row skipped; a read listed twice keeps its last taxID
+            taxa AS (
+                SELECT read_id, last(tax_id ORDER BY rn) AS tax_id
+                FROM centrifuge
+                WHERE rn > 1 AND tax_id IS NOT NULL AND read_id IN (SELECT read_id FROM hits)
+                GROUP BY read_id
+            )
+            SELECT h.read_id,
+                   CASE WHEN h.read_id IN (SELECT read_id FROM plasmid)
+                        THEN 'plasmid' ELSE 'genome' END AS plasmid_match,
+                   h.type, h.gene_name, h.gene_length, h.start, h."end", h.strand,
+                   coalesce(t.tax_id, '0') AS taxID
+            FROM hits h LEFT JOIN taxa t ON h.read_id = t.read_id
+            ORDER BY h.src, h.rn
+        """
+        con = duckdb.connect(config={'threads': self.config.get('threads', 1)})
+        try:
+            con.execute("SET enable_progress_bar = false")
+            con.register('mge', mge)
+            con.sql(query, params=params).write_csv(output_file, sep='\t', header=True)
+        finally:
+            con.close()
     
     def parse_mge_results(self, mge_file):
         """Parse filtered MGE results"""
-        hits = []
+        hits = pd.DataFrame(columns=HIT_COLUMNS)
         try:
-            df = pd.read_csv(mge_file, sep='\t')
-            for _, row in df.iterrows():
-                hits.append({
-                    'read_id': row['t_name'],
-                    'type': 'MGE',
-                    'gene_name': row['q_name'],
-                    'gene_length': row['q_len'],
-                    'start': row['t_start'],
-                    'end': row['t_end'],
-                    'strand': row['strand'][1] if len(row['strand']) > 1 else '+'
-                })
+            hits = self.mge_hits(pd.read_csv(mge_file, sep='\t'))
         except Exception as e:
             logger.error(f"Error parsing MGE results: {e}")
         
         return hits
+    
+    def mge_hits(self, df):
+        """Convert filtered MGE hits to the merge hit columns"""
+        # PSL strand is query+target for translated hits; keep the target strand
+        strand = df['strand'].astype(str)
+        strand = strand.str.slice(1, 2).where(strand.str.len() > 1, '+')
+        return (df[['t_name', 'q_name', 'q_len', 't_start', 't_end']]
+                .assign(strand=strand)
+                .rename(columns={'t_name': 'read_id', 'q_name': 'gene_name',
+                                 'q_len': 'gene_length', 't_start': 'start',
+                                 't_end': 'end'})
+                .assign(type='MGE')
+                [HIT_COLUMNS])
 
-def run_analysis_pipeline(input_path, sample_name, config, **kwargs):
+def run_analysis_pipeline(input_path, sample_name, config, output_dir=None, **kwargs):
     """Main function to run analysis pipeline"""
-    pipeline = AnalysisPipeline(config)
+    pipeline = AnalysisPipeline(config, output_dir)
     return pipeline.run(input_path, sample_name, **kwargs)
\ No newline at end of file
@@ -6,11 +6,15 @@ L-EasyARG: A comprehensive tool for analyzing antibiotic resistance genes from m
 import os
 import sys
 import argparse
-import yaml
+import json
 import logging
 from pathlib import Path
-from easy_arg.analysis import run_analysis_pipeline
-from easy_arg.plotting import run_plotting_pipeline
+from typing import TypedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configure logging
 logging.basicConfig(
@@ -20,9 +24,69 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def load_config(config_file=None):
+class DatabaseConfig(TypedDict):
+    """Paths of the reference databases"""
+    card: str
+    plsdb: str
+    mge: str
+    centrifuge: str
+    who_species: str
+
+class Config(TypedDict, total=False):
+    """Settings read by the pipeline; see config.yaml for their meaning"""
+    database: DatabaseConfig
+    threads: int
+    minimap2_K: str
+    minimap2_I: str
+    stream_fasta: bool
+    cache_dir: str
+    use_duckdb: bool
+    r_session: bool
+    min_identity: float
+    min_coverage: float
+
+def _json_loads(data):
+    """Parse JSON with orjson when it is installed"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def _json_dumps(obj):
+    """Serialize to UTF-8 JSON bytes with orjson when it is installed"""
+    return orjson.dumps(obj) if orjson is not None else json.dumps(obj).encode()
+
+def _yaml_loader():
+    """PyYAML's safe loader, using LibYAML's C parser when PyYAML was built with it"""
+    import yaml
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+def read_user_config(config_file):
+    """Parse a YAML config file, reusing a JSON copy cached next to it"""
+    cache_file = config_file + ".json"
+    mtime = os.stat(config_file).st_mtime_ns
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = _json_loads(f.read())
+        if cached.get("_mtime") == mtime:
+            return cached["config"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    
+    import yaml
+    with open(config_file, 'r') as f:
+        user_config = yaml.load(f, Loader=_yaml_loader())
+    
+    try:
+        text = _json_dumps({"_mtime": mtime, "config": user_config})
+        if _json_loads(text)["config"] == user_config:
+            from easy_arg.utils import atomic_path
+            with atomic_path(cache_file) as tmp_file, open(tmp_file, 'wb') as f:
+                f.write(text)
+    except (OSError, TypeError, ValueError):
+        pass
+    return user_config
+
+def load_config(config_file=None) -> Config:
     """Load configuration from file or use defaults"""
-    default_config = {
+    default_config: Config = {
         "database": {
             "card": "L-EasyARG-database/card_database/nucleotide_fasta_protein_homolog_model.fasta",
             "plsdb": "L-EasyARG-database/plsdb/sequences.fasta",
@@ -31,20 +95,21 @@ def load_config(config_file=None):
             "who_species": "L-EasyARG-database/2024-WHO-species.txt"
         },
         "threads": 56,
+        "minimap2_K": "500M",
+        "minimap2_I": "8G",
+        "stream_fasta": False,
+        "use_duckdb": False,
+        "r_session": False,
         "min_identity": 0.75,
         "min_coverage": 0.7
     }
     
     if config_file and os.path.exists(config_file):
         try:
-            with open(config_file, 'r') as f:
-                user_config = yaml.safe_load(f)
-                # Merge with defaults
-                for key in user_config:
-                    if key in default_config and isinstance(default_config[key], dict):
-                        default_config[key].update(user_config[key])
-                    else:
-                        default_config[key] = user_config[key]
+            user_config = read_user_config(config_file) or {}
+            # Merge with defaults; database is the only nested section
+            database = {**default_config["database"], **(user_config.get("database") or {})}
+            default_config = {**default_config, **user_config, "database": database}
             logger.info(f"Loaded configuration from {config_file}")
         except Exception as e:
             logger.error(f"Error loading config file: {e}")
@@ -60,6 +125,7 @@ def setup_directories(output_dir):
 
 def create_default_config(output_file="config.yaml"):
     """Create a default configuration file"""
+    import yaml
     config = load_config()
     try:
         with open(output_file, 'w') as f:
@@ -111,7 +177,7 @@ Examples:
     plot_parser = subparsers.add_parser("plot", help="Generate plots from analysis results")
     plot_parser.add_argument("--type", choices=["all", "top10", "distribution", "network", "cooccurrence"], 
                            default="all", help="Type of plot to generate")
-    plot_parser.add_argument("--sample", "-s", help="Sample name for individual plots")
+    plot_parser.add_argument("--sample", "-s", help="Sample name for individual plots (default: every sample in merged/)")
     plot_parser.add_argument("--input-dir", "-i", default=".", help="Input directory with analysis results")
     plot_parser.add_argument("--output-dir", "-o", default="plots", help="Output directory for plots")
     plot_parser.add_argument("--config", "-c", help="Configuration file")
@@ -136,6 +202,8 @@ Examples:
     config = load_config(args.config)
     
     if args.command == "run":
+        from easy_arg.analysis import run_analysis_pipeline
+        
         # Update config with command line arguments
         if args.threads:
             config["threads"] = args.threads
@@ -145,18 +213,23 @@ Examples:
             args.sample = Path(args.input).stem.replace(".fastq.gz", "").replace(".fq.gz", "").replace(".fastq", "").replace(".fq", "")
         
         # Setup directories
-        setup_directories(args.output)
+        output_dir = os.path.abspath(args.output)
+        setup_directories(output_dir)
         
-        # Change to output directory for processing
-        original_cwd = os.getcwd()
-        os.chdir(args.output)
+        # Relative database paths are resolved against the output directory,
+        # which used to be the working directory of the pipeline
+        config["database"] = {
+            name: os.path.join(output_dir, os.path.expanduser(path)) if path else path
+            for name, path in config["database"].items()
+        }
         
         try:
             # Run analysis
             run_analysis_pipeline(
-                input_path=os.path.abspath(os.path.join(original_cwd, args.input)),
+                input_path=os.path.abspath(args.input),
                 sample_name=args.sample,
                 config=config,
+                output_dir=output_dir,
                 skip_dehost=args.skip_dehost,
                 skip_centrifuge=args.skip_centrifuge
             )
@@ -164,10 +237,10 @@ Examples:
         except Exception as e:
             logger.error(f"Analysis failed: {e}")
             sys.exit(1)
-        finally:
-            os.chdir(original_cwd)
         
     elif args.command == "plot":
+        from easy_arg.plotting import run_plotting_pipeline
+        
         # Run plotting
         try:
             run_plotting_pipeline(
@@ -1,32 +1,146 @@
+import functools
+import mmap
+import multiprocessing
 import os
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import logging
 from pathlib import Path
-import matplotlib.pyplot as plt
 import numpy as np
+from .utils import atomic_path
 
 logger = logging.getLogger(__name__)
 
 def run_plotting_pipeline(plot_type, sample_name=None, input_dir=".", output_dir="plots", config=None):
     """Run plotting pipeline"""
     
+    input_dir = os.path.abspath(input_dir)
+    output_dir = os.path.abspath(output_dir)
     os.makedirs(output_dir, exist_ok=True)
     
-    if plot_type in ["all", "top10"]:
-        if sample_name:
-            plot_top10_args(sample_name, input_dir, output_dir, config)
-        else:
-            logger.error("Sample name required for top10 plot")
+    # The R plots only wait on their Rscript child and write separate
+    # files, so they run side by side while pyplot stays on this thread
+    r_plots = {
+        "distribution": plot_arg_distribution,
+        "network": plot_network,
+        "cooccurrence": plot_cooccurrence,
+    }
+    r_plots = {name: func for name, func in r_plots.items() if plot_type in ["all", name]}
     
-    if plot_type in ["all", "distribution"]:
-        plot_arg_distribution(input_dir, output_dir, config)
+    with ThreadPoolExecutor(max_workers=max(1, len(r_plots))) as executor:
+        futures = {executor.submit(func, input_dir, output_dir, config): name
+                   for name, func in r_plots.items()}
+        
+        if plot_type in ["all", "top10"]:
+            samples = [sample_name] if sample_name else _merged_samples(input_dir)
+            if samples:
+                plot_top10_samples(samples, input_dir, output_dir, config)
+            else:
+                logger.error("No sample given and no merged results found for top10 plot")
+        
+        # Report every failed plot before raising the first failure
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Error generating {futures[future]} plot: {e}")
+                errors.append(e)
+    if errors:
+        raise errors[0]
+
+def _merged_samples(input_dir):
+    """Names of the samples with a merged results table in input_dir"""
+    suffix = "_merged_results.tsv"
+    return sorted(p.name[:-len(suffix)] for p in Path(input_dir, "merged").glob(f"*{suffix}"))
+
+def plot_top10_samples(samples, input_dir, output_dir, config):
+    """Plot top 10 ARG subtypes for each sample in spawned worker processes"""
+    if len(samples) == 1:
+        plot_top10_args(samples[0], input_dir, output_dir, config)
+        return
     
-    if plot_type in ["all", "network"]:
-        plot_network(input_dir, output_dir, config)
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(min(len(samples), os.cpu_count() or 1)) as pool:
+        pool.starmap(plot_top10_args, [(s, input_dir, output_dir, config) for s in samples])
+
+def _pyplot():
+    """Import pyplot on the Agg backend, skipping GUI toolkits for batch PDFs"""
+    import matplotlib
+    matplotlib.use("Agg", force=True)
+    import matplotlib.pyplot as plt
+    plt.rcParams.update({
+        'text.usetex': False,
+        'path.simplify_threshold': 1.0,
+        'pdf.compression': 6,
+    })
+    return plt
+
+@functools.lru_cache(maxsize=64)
+def _sample_length(path, mtime, sample_name):
+    """Base pairs on a sample's first valid line of sum_length.txt, or 0"""
+    key = f"{sample_name}\t".encode()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            start = len(key) if m[:len(key)] == key else -1
+            search = 0
+            while True:
+                if start == -1:
+                    pos = m.find(b'\n' + key, search)
+                    if pos == -1:
+                        return 0
+                    start = pos + 1 + len(key)
+                end = m.find(b'\n', start)
+                if end == -1:
+                    end = len(m)
+                try:
+                    return int(m[start:end].split(b'\t', 1)[0])
+                except ValueError:
+                    search, start = end, -1
+
+def _top_counts(values, n):
+    """Most frequent values of a categorical Series, ties in order of first appearance"""
+    codes = values.cat.codes.to_numpy()
+    codes = codes[codes >= 0]
+    present, first = np.unique(codes, return_index=True)
+    counts = np.bincount(codes)[present]
+    top = np.lexsort((first, -counts))[:n]
+    return pd.Series(counts[top], index=values.cat.categories[present[top]])
+
+def _count_args(merged_file):
+    """Count each ARG in a merged results table, most frequent first"""
+    df = pd.read_csv(merged_file, sep='\t', usecols=['type', 'gene_name'],
+                     dtype={'gene_name': 'category', 'type': 'category'}, engine='c')
+    # Compare the integer category codes rather than the type strings
+    types = df['type'].cat
+    if 'ARG' in types.categories:
+        arg_mask = types.codes.to_numpy() == types.categories.get_loc('ARG')
+    else:
+        arg_mask = np.zeros(len(df), dtype=bool)
+    return _top_counts(df['gene_name'][arg_mask], None)
+
+def _load_arg_counts(merged_file):
+    """ARG counts of a merged results table, cached in a parquet file"""
+    cache_file = merged_file + ".counts.parquet"
+    try:
+        if os.stat(cache_file).st_mtime_ns >= os.stat(merged_file).st_mtime_ns:
+            cached = pd.read_parquet(cache_file)
+            return pd.Series(cached['n'].to_numpy(), index=pd.Index(cached['gene_name']))
+    except (OSError, ImportError, ValueError, KeyError):
+        pass
     
-    if plot_type in ["all", "cooccurrence"]:
-        plot_cooccurrence(input_dir, output_dir, config)
+    arg_counts = _count_args(merged_file)
+    try:
+        with atomic_path(cache_file) as tmp_file:
+            pd.DataFrame({'gene_name': arg_counts.index.astype(str),
+                          'n': arg_counts.to_numpy()}).to_parquet(tmp_file, index=False)
+    except (OSError, ImportError, ValueError):
+        pass
+    return arg_counts
 
 def plot_top10_args(sample_name, input_dir, output_dir, config):
     """Plot top 10 ARG subtypes (Python implementation)"""
@@ -42,12 +156,8 @@ def plot_top10_args(sample_name, input_dir, output_dir, config):
     length_file = os.path.join(input_dir, "sum_length.txt")
     sample_bp = 0
     if os.path.exists(length_file):
-        with open(length_file, 'r') as f:
-            for line in f:
-                parts = line.strip().split('\t')
-                if len(parts) >= 2 and parts[0] == sample_name:
-                    sample_bp = int(parts[1])
-                    break
+        mtime = os.stat(length_file).st_mtime_ns
+        sample_bp = _sample_length(length_file, mtime, sample_name)
     
     if sample_bp == 0:
         logger.warning(f"No base pair length found for {sample_name}")
@@ -55,20 +165,16 @@ def plot_top10_args(sample_name, input_dir, output_dir, config):
     
     # Load data
     try:
-        df = pd.read_csv(merged_file, sep='\t')
-        arg_df = df[df['type'] == 'ARG']
+        plt = _pyplot()
         
-        if len(arg_df) == 0:
+        arg_counts = _load_arg_counts(merged_file)
+        if len(arg_counts) == 0:
             logger.warning(f"No ARG data found for {sample_name}")
             return
         
-        # Calculate abundance
+        # Abundance of the 10 most frequent ARGs
         abundance_factor = 1e9 / sample_bp
-        arg_counts = arg_df['gene_name'].value_counts()
-        arg_abundance = arg_counts * abundance_factor
-        
-        # Get top 10
-        top10 = arg_abundance.head(10)
+        top10 = arg_counts.head(10) * abundance_factor
         
         # Plot
         plt.figure(figsize=(12, 8))
@@ -82,10 +188,8 @@ def plot_top10_args(sample_name, input_dir, output_dir, config):
         bars = plt.barh(range(len(top10)), top10.values, color=colors[:len(top10)], alpha=0.9)
         
         # Add labels
-        for i, bar in enumerate(bars):
-            width = bar.get_width()
-            plt.text(width + max(top10.values)*0.01, bar.get_y() + bar.get_height()/2,
-                    f'{width:.2f}', ha='left', va='center', fontweight='bold')
+        plt.gca().bar_label(bars, labels=[f'{v:.2f}' for v in top10.values],
+                            padding=3, fontweight='bold')
         
         plt.title(f'Top 10 ARG subtypes - {sample_name}', fontsize=14)
         plt.xlabel('Abundance (copies/Gb)', fontsize=12)
@@ -103,6 +207,48 @@ def plot_top10_args(sample_name, input_dir, output_dir, config):
     except Exception as e:
         logger.error(f"Error generating top10 plot: {e}")
 
+# Sources a script in a fresh environment whose commandArgs() returns the
+# given arguments, as if the script had been run by Rscript
+R_SOURCE_WITH_ARGS = """
+function(script, args) {
+    env <- new.env(parent = globalenv())
+    env$commandArgs <- function(trailingOnly = FALSE) {
+        if (trailingOnly) args else c("Rscript", paste0("--file=", script), "--args", args)
+    }
+    source(script, local = env)
+    invisible(NULL)
+}
+"""
+
+# The embedded R interpreter is single threaded
+_R_LOCK = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def _r_session():
+    """R_SOURCE_WITH_ARGS in an embedded R session, or None without rpy2"""
+    try:
+        import rpy2.robjects as robjects
+    except ImportError:
+        logger.warning("r_session is set but rpy2 is not installed; running Rscript")
+        return None
+    return robjects.r(R_SOURCE_WITH_ARGS)
+
+def _run_r_script(r_script, args, config):
+    """Run an R plotting script, in the shared R session when r_session is set"""
+    cmd = ["Rscript", str(r_script)] + args
+    if config and config.get('r_session'):
+        with _R_LOCK:
+            source = _r_session()
+            if source is not None:
+                from rpy2.rinterface_lib.embedded import RRuntimeError
+                from rpy2.robjects.vectors import StrVector
+                try:
+                    source(str(r_script), StrVector(args))
+                except RRuntimeError as e:
+                    raise subprocess.CalledProcessError(1, cmd, stderr=str(e)) from e
+                return
+    subprocess.run(cmd, check=True)
+
 def plot_arg_distribution(input_dir, output_dir, config):
     """Plot ARG distribution across WHO priority pathogens"""
     logger.info("Generating ARG distribution plot...")
@@ -112,16 +258,12 @@ def plot_arg_distribution(input_dir, output_dir, config):
     r_script = Path(__file__).parent / "scripts" / "R" / "R2_arg_distribution.R"
     
     if r_script.exists():
-        try:
-            cmd = [
-                "Rscript", str(r_script),
-                "--input", input_dir,
-                "--output", output_dir,
-                "--who-list", config['database']['who_species']
-            ]
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error running R script: {e}")
+        args = [
+            "--input", input_dir,
+            "--output", output_dir,
+            "--who-list", config['database']['who_species']
+        ]
+        _run_r_script(r_script, args, config)
     else:
         logger.warning(f"R script not found at {r_script}")
 
@@ -131,11 +273,7 @@ def plot_network(input_dir, output_dir, config):
     
     r_script = Path(__file__).parent / "scripts" / "R" / "R3_network.R"
     if r_script.exists():
-        try:
-            cmd = ["Rscript", str(r_script), "--input", input_dir, "--output", output_dir]
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error running R script: {e}")
+        _run_r_script(r_script, ["--input", input_dir, "--output", output_dir], config)
     else:
         logger.warning(f"R script not found at {r_script}")
 
@@ -145,10 +283,6 @@ def plot_cooccurrence(input_dir, output_dir, config):
     
     r_script = Path(__file__).parent / "scripts" / "R" / "R4_cooccurrence.R"
     if r_script.exists():
-        try:
-            cmd = ["Rscript", str(r_script), "--input", input_dir, "--output", output_dir]
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error running R script: {e}")
+        _run_r_script(r_script, ["--input", input_dir, "--output", output_dir], config)
     else:
         logger.warning(f"R script not found at {r_script}")
\ No newline at end of file
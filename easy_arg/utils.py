@@ -1,83 +1,236 @@
+import csv
+import http.client
 import os
+import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
 import logging
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from pathlib import Path
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+
+HAVE_PYARROW = pa is not None
 
 logger = logging.getLogger(__name__)
 
+# Absolute paths of the tools found by check_dependencies
+TOOL_PATHS = {}
+
 def check_dependencies():
     """Check if required tools are installed"""
     required_tools = [
         "seqkit", "seqtk", "centrifuge", "minimap2", 
-        "lastal", "lastdb", "maf-convert", "Rscript", "wget", "tar", "unzip"
+        "lastal", "lastdb", "maf-convert", "Rscript", "tar", "unzip"
     ]
     
     missing = []
     for tool in required_tools:
-        # Use shutil.which for a more pythonic check if available, 
-        # but subprocess 'which' is fine for now.
-        if subprocess.run(["which", tool], capture_output=True).returncode != 0:
+        path = TOOL_PATHS.get(tool) or shutil.which(tool)
+        if path is None:
             missing.append(tool)
+        else:
+            TOOL_PATHS[tool] = path
     
     if missing:
         logger.error(f"Missing required tools: {', '.join(missing)}")
         logger.error("Please install them before running L-EasyARG")
         sys.exit(1)
 
-def run_command(cmd, shell=True, capture_output=False):
-    """Run shell command with error handling"""
+def run_command(cmd, shell=False, capture_output=False, pass_fds=(), stdout=None):
+    """Run a command without a shell unless shell=True, optionally writing stdout to a file"""
+    if shell:
+        args = cmd
+    else:
+        args = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+        args[0] = TOOL_PATHS.get(args[0], args[0])
     try:
-        if shell:
-            result = subprocess.run(cmd, shell=True, capture_output=capture_output, 
-                                  text=True, check=True)
-        else:
-            result = subprocess.run(cmd.split(), capture_output=capture_output,
-                                  text=True, check=True)
-        return result
+        if stdout is None:
+            return subprocess.run(args, shell=shell, capture_output=capture_output,
+                                  text=True, check=True, pass_fds=pass_fds)
+        with open(stdout, 'wb') as out:
+            return subprocess.run(args, shell=shell, stdout=out, text=True, check=True,
+                                  pass_fds=pass_fds)
     except subprocess.CalledProcessError as e:
-        logger.error(f"Error running command: {cmd}")
+        logger.error(f"Error running command: {cmd if isinstance(cmd, str) else shlex.join(cmd)}")
         logger.error(f"Error message: {e.stderr}")
         raise
 
+def run_async(func, *args, **kwargs):
+    """Start func on a background thread and return its Future"""
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        return executor.submit(func, *args, **kwargs)
+    finally:
+        executor.shutdown(wait=False)
+
+def run_command_async(cmd, shell=False, capture_output=False):
+    """Start run_command on a background thread and return its Future"""
+    return run_async(run_command, cmd, shell=shell, capture_output=capture_output)
+
+@contextmanager
+def atomic_path(path):
+    """Yield a temporary path that replaces path once the block succeeds"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".")
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def advise_sequential(f):
+    """Hint the kernel that an open file will be read front to back"""
+    try:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        pass
+
+def read_tsv(f, names, usecols):
+    """Read columns usecols of a headerless TSV file object, with Arrow when available"""
+    if HAVE_PYARROW:
+        try:
+            table = pacsv.read_csv(
+                f,
+                read_options=pacsv.ReadOptions(column_names=names),
+                parse_options=pacsv.ParseOptions(delimiter='\t', quote_char=False),
+                convert_options=pacsv.ConvertOptions(include_columns=usecols))
+            return table.to_pandas()
+        except pa.ArrowException as e:
+            logger.debug(f"Arrow TSV reader failed, using pandas: {e}")
+            f.seek(0)
+    return pd.read_csv(f, sep='\t', header=None, names=names, usecols=usecols)
+
+def write_tsv(df, output_file):
+    """Write a DataFrame as TSV, using Arrow's C++ CSV writer when available"""
+    if HAVE_PYARROW:
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            # Arrow quotes header names regardless of quoting_style
+            with open(output_file, 'wb') as f:
+                f.write(('\t'.join(map(str, df.columns)) + '\n').encode())
+                pacsv.write_csv(table, f, write_options=pacsv.WriteOptions(
+                    include_header=False, delimiter='\t', quoting_style='none'))
+            return
+        except pa.ArrowException as e:
+            logger.debug(f"Arrow TSV writer unavailable for {output_file}: {e}")
+    df.to_csv(output_file, sep='\t', index=False)
+
+def _tsv_field_names(path, min_fields, skiprows=0):
+    """Column names covering the first data line of a TSV and at least min_fields"""
+    with open(path, 'rb') as f:
+        for _ in range(skiprows):
+            f.readline()
+        first = f.readline().rstrip(b'\r\n')
+    return range(max(first.count(b'\t') + 1, min_fields))
+
+# Fields of a single ARG/MGE hit
+HIT_COLUMNS = ['read_id', 'type', 'gene_name', 'gene_length', 'start', 'end', 'strand']
+
 def parse_paf(paf_file, gene_type='ARG'):
-    """Parse PAF format file"""
-    hits = []
+    """Parse PAF format file into a DataFrame of hits"""
     try:
-        with open(paf_file, 'r') as f:
-            for line in f:
-                parts = line.strip().split('\t')
-                if len(parts) >= 11:
-                    hits.append({
-                        'read_id': parts[0],
-                        'type': gene_type,
-                        'gene_name': parts[5],
-                        'gene_length': int(parts[6]),
-                        'start': int(parts[2]),
-                        'end': int(parts[3]),
-                        'strand': parts[4]
-                    })
+        if os.path.getsize(paf_file) == 0:
+            return pd.DataFrame(columns=HIT_COLUMNS)
+        # The optional tags after the 12 mandatory fields vary in number
+        df = pd.read_csv(paf_file, sep='\t', header=None,
+                         names=_tsv_field_names(paf_file, 12),
+                         usecols=[0, 2, 3, 4, 5, 6, 10], dtype=str, na_filter=False,
+                         quoting=csv.QUOTE_NONE)
+        df = df[df[10] != '']
+        return pd.DataFrame({
+            'read_id': df[0],
+            'type': gene_type,
+            'gene_name': df[5],
+            'gene_length': df[6].astype('int32'),
+            'start': df[2].astype('int32'),
+            'end': df[3].astype('int32'),
+            'strand': df[4].astype('category'),
+        }, columns=HIT_COLUMNS).reset_index(drop=True)
     except Exception as e:
         logger.error(f"Error parsing PAF file: {e}")
-    
-    return hits
+        return pd.DataFrame(columns=HIT_COLUMNS)
 
-def parse_centrifuge(centrifuge_file):
-    """Parse centrifuge results"""
-    taxid_dict = {}
+def parse_centrifuge_df(centrifuge_file, read_ids=None, chunksize=None):
+    """Parse centrifuge results into a read_id/taxID DataFrame, optionally only read_ids"""
+    columns = ['read_id', 'taxID']
     try:
-        with open(centrifuge_file, 'r') as f:
-            next(f)  # Skip header
-            for line in f:
-                parts = line.strip().split('\t')
-                if len(parts) >= 3:
-                    read_id = parts[0]
-                    taxid = parts[2]
-                    taxid_dict[read_id] = taxid
+        if os.path.getsize(centrifuge_file) == 0:
+            return pd.DataFrame(columns=columns)
+        reader = pd.read_csv(centrifuge_file, sep='\t', header=None, skiprows=1,
+                             names=_tsv_field_names(centrifuge_file, 3, skiprows=1),
+                             usecols=[0, 2],
+                             dtype=str, na_filter=False, quoting=csv.QUOTE_NONE,
+                             chunksize=chunksize)
+        chunks = [reader] if chunksize is None else reader
+        frames = []
+        for chunk in chunks:
+            chunk = chunk.rename(columns={0: 'read_id', 2: 'taxID'})
+            chunk = chunk[chunk['taxID'] != '']
+            if read_ids is not None:
+                chunk = chunk[chunk['read_id'].isin(read_ids)]
+            frames.append(chunk)
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+        return df.drop_duplicates('read_id', keep='last')[columns]
     except Exception as e:
         logger.error(f"Error parsing centrifuge file: {e}")
+        return pd.DataFrame(columns=columns)
+
+def parse_centrifuge(centrifuge_file):
+    """Parse centrifuge results"""
+    df = parse_centrifuge_df(centrifuge_file)
+    return dict(zip(df['read_id'].to_numpy(), df['taxID'].to_numpy()))
+
+DOWNLOAD_CHUNK_BYTES = 1 << 20
+
+def _download(url, dst):
+    """Stream url to dst through a .part file, resuming a partial download"""
+    part = dst + ".part"
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+    try:
+        response = urllib.request.urlopen(request, timeout=60)
+    except urllib.error.HTTPError as e:
+        # The part file already holds the whole resource
+        if e.code != 416:
+            raise
+        response = None
+    if response is not None:
+        # A server that ignores the range request sends the whole file
+        resume = offset and response.status == 206
+        with response, open(part, 'ab' if resume else 'wb') as f:
+            while chunk := response.read(DOWNLOAD_CHUNK_BYTES):
+                f.write(chunk)
+            # read() ends quietly when the connection drops mid-body
+            if response.length:
+                raise http.client.IncompleteRead(b"", response.length)
+    os.replace(part, dst)
+
+def _setup_database(db_name, db_path, db_info):
+    """Download and extract one database"""
+    filename = os.path.basename(urllib.parse.urlparse(db_info['url']).path)
+    archive = os.path.join(db_path, filename)
+    if not os.path.exists(archive):
+        logger.info(f"  Downloading {db_name} from {db_info['url']}")
+        _download(db_info['url'], archive)
     
-    return taxid_dict
+    # Extract/setup
+    logger.info(f"  Extracting/setting up {db_name}...")
+    subprocess.run(db_info['cmd'], shell=True, check=True, cwd=db_path)
 
 def setup_databases(database_dir, skip_download=False):
     """Setup required databases"""
@@ -114,6 +267,7 @@ def setup_databases(database_dir, skip_download=False):
         }
     }
     
+    pending = {}
     for db_name, db_info in databases.items():
         db_path = os.path.join(database_dir, db_name)
         if db_name == "mge":
@@ -133,21 +287,20 @@ def setup_databases(database_dir, skip_download=False):
 
         if not skip_download:
             if db_info['url']:
-                # Download
-                logger.info(f"  Downloading from {db_info['url']}")
-                try:
-                    download_cmd = f"cd {db_path} && wget -q {db_info['url']}"
-                    subprocess.run(download_cmd, shell=True, check=True)
-                    
-                    # Extract/setup
-                    logger.info(f"  Extracting/setting up...")
-                    setup_cmd = f"cd {db_path} && {db_info['cmd']}"
-                    subprocess.run(setup_cmd, shell=True, check=True)
-                except subprocess.CalledProcessError as e:
-                    logger.error(f"Failed to setup {db_name}: {e}")
+                pending[db_name] = (db_path, db_info)
             else:
                 logger.warning(f"  No download URL for {db_name}. Please install manually.")
         else:
             logger.info(f"  Skipping download (using existing files)")
     
+    # Downloads are network bound, so fetch the databases concurrently
+    with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+        futures = {executor.submit(_setup_database, db_name, *args): db_name
+                   for db_name, args in pending.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (OSError, http.client.HTTPException, subprocess.CalledProcessError) as e:
+                logger.error(f"Failed to setup {futures[future]}: {e}")
+    
     logger.info("\n✓ Database setup completed!")
\ No newline at end of file
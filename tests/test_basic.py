@@ -0,0 +1,285 @@
+import http.client
+import http.server
+import random
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import easy_arg._fastfilter as fastfilter
+import easy_arg.analysis as analysis
+from easy_arg.analysis import AnalysisPipeline, _index_lines, _mmap_tab_int
+from easy_arg.utils import _download, atomic_path
+
+
+def _paf_line(rng):
+    """A random PAF record, sometimes short or with a non-numeric field"""
+    fields = [f"read{rng.randrange(50)}", "1000", "0", "900", "+", f"gene{rng.randrange(20)}",
+              str(rng.randrange(0, 2000)), "0", "900",
+              str(rng.randrange(0, 1000)), str(rng.randrange(0, 1200)), "60"]
+    kind = rng.random()
+    if kind < 0.1:
+        fields = fields[:rng.randrange(1, 11)]
+    elif kind < 0.2:
+        fields[rng.choice([6, 9, 10])] = rng.choice(["x12", "12x", "", "-5", "1.5"])
+    elif kind < 0.5:
+        fields += ["tp:A:P", "cm:i:12"]
+    return "\t".join(fields)
+
+
+def _filter_reference(text, min_identity, min_coverage):
+    """Lines a record-by-record filter keeps, skipping unparsable records"""
+    kept = []
+    for line in text.splitlines(keepends=True):
+        parts = line.rstrip("\n").split("\t")
+        if len(parts) < 11 or not all(parts[i].isdigit() for i in (6, 9, 10)):
+            continue
+        matches, aln_len, target_len = int(parts[9]), int(parts[10]), int(parts[6])
+        identity = matches / aln_len if aln_len > 0 else 0
+        coverage = aln_len / target_len if target_len > 0 else 0
+        if identity >= min_identity and coverage >= min_coverage:
+            kept.append(line)
+    return "".join(kept)
+
+
+@pytest.mark.parametrize("use_numba", [True, False])
+@pytest.mark.parametrize("chunk_bytes", [analysis.PAF_CHUNK_BYTES, 97, 4096])
+@pytest.mark.parametrize("trailing_newline", [True, False])
+def test_filter_paf_matches_reference(tmp_path, monkeypatch, use_numba, chunk_bytes, trailing_newline):
+    if use_numba and not fastfilter.HAVE_NUMBA:
+        pytest.skip("numba is not installed")
+    monkeypatch.setattr(fastfilter, "HAVE_NUMBA", use_numba)
+    rng = random.Random(chunk_bytes)
+    text = "\n".join(_paf_line(rng) for _ in range(2000))
+    if trailing_newline:
+        text += "\n"
+    # Small windows make records straddle window boundaries
+    monkeypatch.setattr(analysis, "PAF_CHUNK_BYTES", chunk_bytes)
+    paf, out = tmp_path / "in.paf", tmp_path / "out.txt"
+    paf.write_text(text)
+    AnalysisPipeline({}, str(tmp_path)).filter_paf(str(paf), str(out), 0.5, 0.5)
+    assert out.read_text() == _filter_reference(text, 0.5, 0.5)
+
+
+def test_filter_paf_empty_file(tmp_path):
+    paf, out = tmp_path / "in.paf", tmp_path / "out.txt"
+    paf.write_bytes(b"")
+    AnalysisPipeline({}, str(tmp_path)).filter_paf(str(paf), str(out), 0.5, 0.5)
+    assert out.read_bytes() == b""
+
+
+@pytest.mark.parametrize("offset", range(9))
+def test_mmap_tab_int_unaligned_buffer(offset):
+    text = b"a\t12\t7\nb\t\t3\nc\t4x\t5\nd\ne\t0\t123456789012345678"
+    raw = bytes(offset) + text
+    buf = np.frombuffer(raw, dtype=np.uint8, offset=offset)
+    index = _index_lines(buf)
+    values, valid = _mmap_tab_int(buf, index, 1)
+    assert valid.tolist() == [True, False, False, False, True]
+    assert values[valid].tolist() == [12, 0]
+    values, valid = _mmap_tab_int(buf, index, 2)
+    assert valid.tolist() == [True, True, True, False, True]
+    assert values[valid].tolist() == [7, 3, 5, 123456789012345678]
+
+
+needs_numba = pytest.mark.skipif(not fastfilter.HAVE_NUMBA, reason="numba is not installed")
+
+
+@needs_numba
+@pytest.mark.parametrize("offset", range(9))
+@pytest.mark.parametrize("size", [0, 1, 7, 8, 9, 63, 64, 65, 1000])
+def test_find_tabs_nl_jit_matches_numpy(offset, size):
+    rng = np.random.default_rng(size * 16 + offset)
+    raw = rng.choice(np.frombuffer(b"\t\nab0", dtype=np.uint8), size=size + offset)
+    buf = raw[offset:]
+    tabs, newlines = fastfilter._find_tabs_nl_jit(buf)
+    ref_tabs, ref_newlines = fastfilter._find_tabs_nl_numpy(buf)
+    assert tabs.tolist() == ref_tabs.tolist()
+    assert newlines.tolist() == ref_newlines.tolist()
+
+
+@needs_numba
+@pytest.mark.parametrize("fill", [b"\t", b"\n", b"\t\n"])
+def test_find_tabs_nl_jit_grows_output(fill):
+    # Dense separators overflow the initial output arrays several times
+    buf = np.frombuffer(fill * 5000 + b"x", dtype=np.uint8)
+    tabs, newlines = fastfilter._find_tabs_nl_jit(buf)
+    ref_tabs, ref_newlines = fastfilter._find_tabs_nl_numpy(buf)
+    assert tabs.tolist() == ref_tabs.tolist()
+    assert newlines.tolist() == ref_newlines.tolist()
+
+
+@needs_numba
+def test_paf_keep_mask_jit_matches_numpy():
+    rng = np.random.default_rng(0)
+    matches, aln_len, target_len = rng.integers(0, 100, size=(3, 1000))
+    keep = fastfilter._paf_keep_mask_jit(matches, aln_len, target_len, 0.7, 0.5)
+    ref = fastfilter._paf_keep_mask_numpy(matches, aln_len, target_len, 0.7, 0.5)
+    assert keep.tolist() == ref.tolist()
+
+
+@needs_numba
+def test_overlap_remove_mask_jit_matches_numpy():
+    rng = np.random.default_rng(1)
+    n = 1000
+    name_codes = np.sort(rng.integers(0, 50, size=n))
+    t_start = rng.integers(0, 500, size=n)
+    t_end = t_start + rng.integers(0, 200, size=n)
+    order = np.lexsort((t_start, name_codes))
+    name_codes, t_start, t_end = name_codes[order], t_start[order], t_end[order]
+    identity = rng.random(n)
+    remove = fastfilter._overlap_remove_mask_jit(name_codes, t_start, t_end, identity)
+    ref = fastfilter._overlap_remove_mask_numpy(name_codes, t_start, t_end, identity)
+    assert remove.tolist() == ref.tolist()
+
+
+MGE_HEADER = ("matches\tstrand\tq_name\tq_len\tq_start\tq_end\tt_name\tt_len\t"
+              "t_start\tt_end\tblock_count\n")
+
+
+def _write_merge_inputs(root, mge_rows):
+    for d in analysis.WORK_DIRS:
+        (root / d).mkdir()
+    paf = "5000\t1\t100\t+\t{}\t861\t0\t861\t800\t861\t60"
+    (root / "ARG" / "S_ARG_filtered.txt").write_text(
+        "".join(f"read{i}\t{paf.format(f'geneA{i % 4}')}\n" for i in range(8))
+        # Optional tags make the rows ragged
+        + f"read8\t{paf.format('geneA0')}\ttp:A:P\tcg:Z:5M\n"
+        + f"read9\t{paf.format('geneA1')}\tNM:i:3\n")
+    (root / "plsdb" / "S_plsdb_filtered.txt").write_text(
+        "".join(f"read{i}\t{paf.format('p')}\n" for i in (0, 3, 6, 9)))
+    (root / "MGE" / "S_filtered_hits.txt").write_text(MGE_HEADER + mge_rows)
+    # read2 is listed twice; its last taxID wins
+    (root / "centrifuge" / "S_result.tsv").write_text(
+        "readID\tseqID\ttaxID\tscore\n"
+        + "".join(f"read{i}\ts\t{100 + i}\t1\n" for i in range(0, 10, 2))
+        + "read2\ts\t999\t1\nread11\ts\t5\t1\n")
+
+
+@pytest.mark.parametrize("mge_rows", [
+    "",
+    "700\t++\tmgeA\t300\t0\t290\tread1\t5000\t10\t900\t1\n"
+    "650\t+-\tmgeB\t300\t5\t280\tread12\t5000\t2000\t2800\t1\n",
+])
+def test_merge_results_duckdb_matches_pandas(tmp_path, mge_rows):
+    pytest.importorskip("duckdb")
+    _write_merge_inputs(tmp_path, mge_rows)
+    output = tmp_path / "merged" / "S_merged_results.tsv"
+    AnalysisPipeline({}, str(tmp_path)).merge_results("S")
+    expected = output.read_bytes()
+    output.unlink()
+    # Called directly so a DuckDB error cannot fall back to the pandas merge
+    AnalysisPipeline({"threads": 2}, str(tmp_path)).merge_results_duckdb("S")
+    assert output.read_bytes() == expected
+    assert b"read2\tgenome\tARG\tgeneA2\t861\t1\t100\t+\t999\n" in expected
+
+
+def test_merge_results_keeps_quoted_and_na_read_ids(tmp_path):
+    for d in analysis.WORK_DIRS:
+        (tmp_path / d).mkdir()
+    paf = "5000\t1\t100\t+\tgeneA\t861\t0\t861\t800\t861\t60\n"
+    read_ids = ['"quoted', 'NA', 'null', 'plain']
+    (tmp_path / "ARG" / "S_ARG_filtered.txt").write_text("".join(f"{r}\t{paf}" for r in read_ids))
+    (tmp_path / "plsdb" / "S_plsdb_filtered.txt").write_text(
+        "".join(f"{r}\t{paf}" for r in read_ids[:3]))
+    AnalysisPipeline({}, str(tmp_path)).merge_results("S")
+    merged = pd.read_csv(tmp_path / "merged" / "S_merged_results.tsv", sep="\t",
+                         dtype=str, na_filter=False)
+    assert merged[["read_id", "plasmid_match"]].values.tolist() == [
+        ['"quoted', 'plasmid'], ['NA', 'plasmid'], ['null', 'plasmid'], ['plain', 'genome']]
+
+
+DOWNLOAD_DATA = bytes(range(256)) * 4000
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves DOWNLOAD_DATA, honouring Range except under /norange"""
+    def do_GET(self):
+        self.server.ranges.append(self.headers.get("Range"))
+        body, status = DOWNLOAD_DATA, 200
+        range_header = self.headers.get("Range")
+        if range_header and self.path != "/norange":
+            start = int(range_header[len("bytes="):].rstrip("-"))
+            if start >= len(DOWNLOAD_DATA):
+                self.send_response(416)
+                self.end_headers()
+                return
+            body, status = DOWNLOAD_DATA[start:], 206
+        self.send_response(status)
+        if self.path == "/truncated":
+            # Announce the full length but close after half of it
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2])
+            return
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    server.ranges = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("path, partial, expected_range", [
+    ("/db", 0, None),
+    # Resumed with a 206 response
+    ("/db", 300000, "bytes=300000-"),
+    # The server answers the range request with 200; the download restarts
+    ("/norange", 300000, "bytes=300000-"),
+    # The part file is already complete; the server answers 416
+    ("/db", len(DOWNLOAD_DATA), f"bytes={len(DOWNLOAD_DATA)}-"),
+])
+def test_download_resumes_part_file(tmp_path, http_server, path, partial, expected_range):
+    dst = tmp_path / "db.tar.gz"
+    if partial:
+        (tmp_path / "db.tar.gz.part").write_bytes(DOWNLOAD_DATA[:partial])
+    _download(f"http://127.0.0.1:{http_server.server_port}{path}", str(dst))
+    assert dst.read_bytes() == DOWNLOAD_DATA
+    assert not (tmp_path / "db.tar.gz.part").exists()
+    assert http_server.ranges == [expected_range]
+
+
+def test_download_keeps_truncated_part_for_resume(tmp_path, http_server):
+    dst = tmp_path / "db.tar.gz"
+    url = f"http://127.0.0.1:{http_server.server_port}"
+    with pytest.raises(http.client.HTTPException):
+        _download(url + "/truncated", str(dst))
+    assert not dst.exists()
+    assert DOWNLOAD_DATA.startswith((tmp_path / "db.tar.gz.part").read_bytes())
+    _download(url + "/db", str(dst))
+    assert dst.read_bytes() == DOWNLOAD_DATA
+
+
+def test_atomic_path_concurrent_writers(tmp_path):
+    target = tmp_path / "cache.json"
+    payloads = [str(i).encode() * 100000 for i in range(8)]
+
+    errors = []
+
+    def write(payload):
+        try:
+            with atomic_path(str(target)) as tmp, open(tmp, 'wb') as f:
+                f.write(payload)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(p,)) for p in payloads]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert target.read_bytes() in payloads
+    assert [p.name for p in tmp_path.iterdir()] == ["cache.json"]